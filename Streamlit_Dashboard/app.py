@@ -5,21 +5,33 @@ Streamlit dashboard centered on ATD with robust filters and KPIs.
 from __future__ import annotations
 
 import os
-from typing import List, Optional, Tuple
+import tempfile
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import streamlit as st
-import altair as alt  # used for scatter & histogram
+import altair as alt  # used for distance grid & histogram
 
 from utils import (
     add_derived_fields,
     filter_frame,
+    column_bounds,
     kpi_series,
     resolve_columns,
     agg_by,
+    histogram_frame,
+    grid_frame,
     bar_chart,
     dual_axis_daily,
+    NEEDED,
+    PREPARED_VERSION,
+    CATEGORICAL_KEYS,
+    DAY_LABELS,
+    WEEKEND_LABELS,
     ATD_COLOR,
     TRIPS_COLOR,
 )
@@ -55,7 +67,7 @@ if mode == "Tutorial":
 
 **How to use filters**
 1. Choose the **dataset** in the sidebar (Data Complete / Without outliers).
-2. Apply filters for **Territory**, **Geo Archetype**, **Courier Flow**, **Merchant Surface**.
+2. Apply filters for **Territory**, **Geo Archetype**, **Courier Flow**, **Merchant Surface** (leave one empty to include all values).
 3. Narrow the **date range** and **pickup/dropoff distance** ranges.
 4. Charts update automatically.
 
@@ -72,8 +84,8 @@ st.sidebar.header("Data")
 
 # Dataset paths (adjust as needed)
 DATA_SOURCES = {
-    "Data Complete": "/mnt/cephfs/hadoop-compute/phoenix/jose.luis.gonzalez/BCAA/data_complete.csv",
-    "Data without outliers": "/mnt/cephfs/hadoop-compute/phoenix/jose.luis.gonzalez/BCAA/data_without_outliers.csv",
+    "Data Complete": "/mnt/cephfs/hadoop-compute/phoenix/jose.luis.gonzalez/BCAA/data_complete.parquet",
+    "Data without outliers": "/mnt/cephfs/hadoop-compute/phoenix/jose.luis.gonzalez/BCAA/data_without_outliers.parquet",
 }
 dataset_choice = st.sidebar.selectbox("Select dataset", list(DATA_SOURCES.keys()))
 data_path = DATA_SOURCES[dataset_choice]
@@ -82,31 +94,137 @@ if not os.path.exists(data_path):
     st.error(f"File not found: {data_path}")
     st.stop()
 
-df = pd.read_csv(data_path)
 
-# ---------------- Preprocessing ---------------- #
+# ---------------- Loading & preprocessing ---------------- #
+SCATTER_SAMPLE = 200_000  # max rows behind the distance grid
+CACHE_ENTRIES = 32  # filter states kept by the aggregation caches
+PREPARED_VERSION_KEY = b"atd_dashboard.prepared_version"
+SOURCE_MTIME_KEY = b"atd_dashboard.source_mtime_ns"
+SOURCE_SIZE_KEY = b"atd_dashboard.source_size"
+
+
+def _prepare_parquet(path: str) -> pd.DataFrame:
+    present = set(pq.read_schema(path).names)
+    raw = pd.read_parquet(path, columns=[c for c in NEEDED if c in present])
+    raw_cols = resolve_columns(raw)
+    out = add_derived_fields(raw, raw_cols)
+    # The raw timestamp strings are dead weight once parsed; every filter copy
+    # would otherwise drag them along.
+    if raw_cols.get("eater_request_ts"):
+        out = out.drop(columns=[raw_cols["eater_request_ts"]])
+    return out
+
+
+def _prepared_meta(path: str) -> Dict[bytes, bytes]:
+    # Ties a prepared frame to the preprocessing version and the exact source file
+    info = os.stat(path)
+    return {
+        PREPARED_VERSION_KEY: str(PREPARED_VERSION).encode(),
+        SOURCE_MTIME_KEY: str(info.st_mtime_ns).encode(),
+        SOURCE_SIZE_KEY: str(info.st_size).encode(),
+    }
+
+
+def _read_prepared(ipc_path: str, expected: Dict[bytes, bytes]) -> Optional[pd.DataFrame]:
+    """The cached prepared frame, or None if unreadable or not built from the expected source."""
+    try:
+        reader = pa.ipc.open_file(pa.memory_map(ipc_path))
+        meta = reader.schema.metadata or {}
+        if any(meta.get(k) != v for k, v in expected.items()):
+            return None
+        return reader.read_all().to_pandas(self_destruct=True)
+    except (pa.ArrowException, OSError):
+        return None  # truncated or corrupt: rebuild from the Parquet
+
+
+def _write_prepared(out: pd.DataFrame, ipc_path: str, meta: Dict[bytes, bytes]) -> None:
+    try:
+        # Unique temp name per writer, then an atomic rename over the old file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(ipc_path) or ".", suffix=".feather.tmp")
+        os.close(fd)
+    except OSError:
+        return  # read-only data dir: run without the warm-start cache
+    try:
+        table = pa.Table.from_pandas(out, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **meta})
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, ipc_path)
+    except (pa.ArrowException, OSError):
+        pass  # the cache is optional: serve the frame without it
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# cache_resource, not cache_data: every session and rerun shares these objects
+# instead of unpickling a fresh copy of the full frame. They are read-only.
+@st.cache_resource(show_spinner=False)
+def load_data(
+    path: str, mtime: float
+) -> Tuple[pd.DataFrame, Dict[str, List[str]], Optional[pd.DataFrame], dict]:
+    """Load the prepared dataset; ``mtime`` invalidates the cache when the Parquet is rewritten.
+
+    Returns the prepared frame, the sidebar options of each categorical dimension,
+    a fixed random sample (filter columns included) backing the distance grid,
+    and the ``column_bounds`` of the filtered columns, which also seed the
+    sidebar date input and sliders. The results are shared by every session and
+    must never be mutated.
+    """
+    # Prepared frames are also kept as an uncompressed Arrow IPC (Feather) file next
+    # to the Parquet, so a restarted server memory-maps it instead of re-deriving.
+    ipc_path = os.path.splitext(path)[0] + ".feather"
+    meta = _prepared_meta(path)
+    out = _read_prepared(ipc_path, meta) if os.path.exists(ipc_path) else None
+    if out is None:
+        out = _prepare_parquet(path)
+        _write_prepared(out, ipc_path, meta)
+    out_cols = resolve_columns(out)
+    options = {
+        key: out[out_cols[key]].cat.categories.tolist()
+        for key in CATEGORICAL_KEYS
+        if out_cols.get(key)
+    }
+    scatter_base = None
+    xyz = [out_cols.get(k) for k in ("pickup_distance", "dropoff_distance", "atd")]
+    if all(xyz):
+        filter_cols = [out_cols[k] for k in CATEGORICAL_KEYS if out_cols.get(k)]
+        scatter_base = out[[*xyz, *filter_cols, "_eater_request_dt"]].dropna(subset=xyz)
+        if scatter_base.shape[0] > SCATTER_SAMPLE:
+            scatter_base = scatter_base.sample(SCATTER_SAMPLE, random_state=7)
+    keys = ("pickup_distance", "dropoff_distance", *CATEGORICAL_KEYS)
+    stats_cols = [out_cols[k] for k in keys if out_cols.get(k)] + ["_eater_request_dt"]
+    stats = column_bounds(out, stats_cols)
+    return out, options, scatter_base, stats
+
+
+# Aggregations are memoized per (dataset, normalized filter state); the frame
+# argument is underscored so Streamlit does not hash it.
+@st.cache_data(max_entries=CACHE_ENTRIES, show_spinner=False)
+def kpi_cached(dataset_key: str, filter_key: tuple, _frame: pd.DataFrame, atd_col: str) -> dict:
+    return kpi_series(_frame, atd_col)
+
+
+# One entry per chart dimension (4 segments, day, hour, weekend, date) per filter state
+@st.cache_data(max_entries=CACHE_ENTRIES * 8, show_spinner=False)
+def agg_by_cached(
+    dataset_key: str, filter_key: tuple, dim: str, _frame: pd.DataFrame, atd_col: str
+) -> pd.DataFrame:
+    return agg_by(_frame, dim, atd_col)
+
+
+data_mtime = os.path.getmtime(data_path)
+df, options_dict, scatter_base, stats = load_data(data_path, data_mtime)
 cols = resolve_columns(df)
-df = add_derived_fields(df, cols)
-
-# Derive temporal columns if missing
-if "_eater_request_dt" in df.columns:
-    dt = pd.to_datetime(df["_eater_request_dt"], errors="coerce")
-    if "hour_of_day" not in df.columns:
-        df["hour_of_day"] = dt.dt.hour
-    if "day_of_week" not in df.columns:
-        df["day_of_week"] = dt.dt.dayofweek  # 0=Mon..6=Sun
-    if "is_weekend" not in df.columns:
-        df["is_weekend"] = dt.dt.dayofweek >= 5
+
 # ---------------- Filters ---------------- #
 st.sidebar.header("Filters")
 
 
 def multiselect_for(col_key: str, label: str) -> Optional[List[str]]:
-    col = cols.get(col_key)
-    if not col:
+    if col_key not in options_dict:
         return None
-    options = sorted([x for x in df[col].dropna().unique().tolist()])
-    return st.sidebar.multiselect(label, options, default=options)
+    # Empty selection means "all", which lets filter_frame skip the column.
+    return st.sidebar.multiselect(label, options_dict[col_key], default=[], placeholder="All")
 
 
 territory = multiselect_for("territory", "Territory")
@@ -116,9 +234,10 @@ merchant_surface = multiselect_for("merchant_surface", "Merchant surface")
 
 # Date range
 date_col = "_eater_request_dt"
-if df[date_col].notna().any():
-    min_dt = pd.to_datetime(df[date_col].min())
-    max_dt = pd.to_datetime(df[date_col].max())
+date_min, date_max, _ = stats[date_col]
+if pd.notna(date_min):
+    min_dt = pd.to_datetime(date_min)
+    max_dt = pd.to_datetime(date_max)
     date_range: Tuple[pd.Timestamp, pd.Timestamp] = st.sidebar.date_input(
         "Date range (Eater request)",
         value=(min_dt, max_dt),
@@ -134,7 +253,7 @@ if df[date_col].notna().any():
 else:
     date_range = None
 
-# Distance ranges (true min/max)
+# Distance ranges (true min/max, precomputed by the loader)
 pickup_col = cols.get("pickup_distance")
 dropoff_col = cols.get("dropoff_distance")
 
@@ -142,7 +261,7 @@ pickup_range = None
 dropoff_range = None
 
 if pickup_col:
-    pmin, pmax = df[pickup_col].min(), df[pickup_col].max()
+    pmin, pmax, _ = stats[pickup_col]
     pickup_range = st.sidebar.slider(
         "Pickup distance",
         min_value=float(np.floor(pmin)),
@@ -152,7 +271,7 @@ if pickup_col:
     )
 
 if dropoff_col:
-    dmin, dmax = df[dropoff_col].min(), df[dropoff_col].max()
+    dmin, dmax, _ = stats[dropoff_col]
     dropoff_range = st.sidebar.slider(
         "Dropoff distance",
         min_value=float(np.floor(dmin)),
@@ -162,9 +281,7 @@ if dropoff_col:
     )
 
 # ---------------- Apply filters ---------------- #
-filtered = filter_frame(
-    df,
-    cols,
+filter_state = dict(
     territory=territory,
     geo_archetype=geo_arch,
     courier_flow=courier_flow,
@@ -173,13 +290,21 @@ filtered = filter_frame(
     pickup_range=pickup_range,
     dropoff_range=dropoff_range,
 )
+filtered = filter_frame(df, cols, bounds=stats, **filter_state)
+
+# Cache keys for kpi_cached / agg_by_cached
+dataset_key = f"{data_path}:{data_mtime}"
+filter_key = tuple(
+    tuple(sorted(v)) if isinstance(v, list) else (tuple(v) if v else None)
+    for v in filter_state.values()
+)
 
 st.caption(f"Filtered rows: {filtered.shape[0]:,} / Total rows: {df.shape[0]:,}")
 
 # ---------------- KPIs ---------------- #
 st.title("ATD Dashboard")
 atd_col = cols.get("atd")
-kpis = kpi_series(filtered, atd_col)
+kpis = kpi_cached(dataset_key, filter_key, filtered, atd_col)
 
 c1, c2, c3, c4 = st.columns(4)
 c1.metric("Trips", f"{kpis['count']:,}")
@@ -192,13 +317,9 @@ getattr(st, "divider", lambda: st.markdown("---"))()
 # ---------------- Charts ---------------- #
 if atd_col:
     # 0) Daily lines: ATD + Trips (dual axis)
-    if filtered["_eater_request_dt"].notna().any():
-        daily = (
-            filtered.assign(date=filtered["_eater_request_dt"].dt.date)
-            .groupby("date")[atd_col]
-            .agg(ATD_mean="mean", count="size")
-            .reset_index()
-        )
+    if pd.notna(stats["_eater_request_dt"][0]):
+        daily = agg_by_cached(dataset_key, filter_key, "date", filtered, atd_col)
+        daily = daily.rename(columns={"dim": "date"})
         st.subheader("Daily ATD and Trips")
         st.altair_chart(dual_axis_daily(daily), use_container_width=True)
 
@@ -210,7 +331,7 @@ if atd_col:
         ("merchant_surface", "Merchant surface"),
     ]:
         if cols.get(dim_key):
-            df_agg = agg_by(filtered, cols[dim_key], atd_col)
+            df_agg = agg_by_cached(dataset_key, filter_key, cols[dim_key], filtered, atd_col)
             st.subheader(f"Average ATD by {label}")
             st.altair_chart(
                 bar_chart(df_agg, label, "ATD_mean", ATD_COLOR, label=True),
@@ -227,10 +348,8 @@ if atd_col:
 
     # Day of week (Mon→Sun)
     if "day_of_week" in filtered.columns:
-        order_days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-        day_map = {0: "Mon", 1: "Tue", 2: "Wed", 3: "Thu", 4: "Fri", 5: "Sat", 6: "Sun"}
-        filtered["_dow_label"] = filtered["day_of_week"].map(day_map)
-        df_dow = agg_by(filtered, "_dow_label", atd_col)
+        order_days = DAY_LABELS
+        df_dow = agg_by_cached(dataset_key, filter_key, "_dow_label", filtered, atd_col)
 
         st.subheader("Average ATD by day of week")
         st.altair_chart(
@@ -246,7 +365,7 @@ if atd_col:
     # Hour of day (0→23)
     if "hour_of_day" in filtered.columns:
         order_hours = list(range(24))
-        df_hour = agg_by(filtered, "hour_of_day", atd_col)
+        df_hour = agg_by_cached(dataset_key, filter_key, "hour_of_day", filtered, atd_col)
 
         st.subheader("Average ATD by hour of day")
         st.altair_chart(
@@ -261,9 +380,8 @@ if atd_col:
 
     # Weekend vs Weekday
     if "is_weekend" in filtered.columns:
-        order_weekend = ["Weekday", "Weekend"]
-        filtered["_is_weekend_label"] = np.where(filtered["is_weekend"], "Weekend", "Weekday")
-        df_wknd = agg_by(filtered, "_is_weekend_label", atd_col)
+        order_weekend = WEEKEND_LABELS
+        df_wknd = agg_by_cached(dataset_key, filter_key, "_is_weekend_label", filtered, atd_col)
 
         st.subheader("Average ATD by weekend vs weekday")
         st.altair_chart(
@@ -276,35 +394,47 @@ if atd_col:
             use_container_width=True,
         )
 
-    # 3) Scatter: Pickup vs Dropoff (bubble size ~ ATD)
-    if pickup_col and dropoff_col:
+    # 3) Pickup vs Dropoff grid (color ~ mean ATD)
+    if scatter_base is not None:
         st.subheader("ATD vs distances (Pickup vs Dropoff)")
-        sample = filtered[[pickup_col, dropoff_col, atd_col]].dropna()
-        if sample.shape[0] > 200_000:
-            sample = sample.sample(200_000, random_state=7)
-
-        scatter = (
-            alt.Chart(sample)
-            .mark_circle(opacity=0.4, color=ATD_COLOR)
+        # Filter the pre-drawn sample rather than sampling the filtered frame,
+        # then aggregate it into grid cells so the chart gets a few hundred rows.
+        sample = filter_frame(scatter_base, cols, bounds=stats, **filter_state)
+        cells = grid_frame(sample, pickup_col, dropoff_col, atd_col)
+
+        grid = (
+            alt.Chart(cells)
+            .mark_rect()
             .encode(
-                x=alt.X(f"{pickup_col}:Q", title="Pickup distance"),
-                y=alt.Y(f"{dropoff_col}:Q", title="Dropoff distance"),
-                size=alt.Size(f"{atd_col}:Q", title="ATD"),
-                tooltip=[pickup_col, dropoff_col, atd_col],
+                x=alt.X("x_lo:Q", title="Pickup distance"),
+                x2="x_hi:Q",
+                y=alt.Y("y_lo:Q", title="Dropoff distance"),
+                y2="y_hi:Q",
+                color=alt.Color("atd_mean:Q", title="ATD (mean)", scale=alt.Scale(scheme="greens")),
+                tooltip=[
+                    alt.Tooltip("count:Q", title="Trips (n)", format=","),
+                    alt.Tooltip("atd_mean:Q", title="ATD mean", format=".2f"),
+                ],
             )
             .properties(height=360)
         )
-        st.altair_chart(scatter, use_container_width=True)
+        st.altair_chart(grid, use_container_width=True)
 
     # 4) ATD distribution
     st.subheader("ATD distribution")
+    # Bin server-side: the chart receives 50 rows instead of every trip
     hist = (
-        alt.Chart(filtered[[atd_col]].dropna())
-        .mark_area(opacity=0.6, color=ATD_COLOR)
+        alt.Chart(histogram_frame(filtered[atd_col]))
+        .mark_bar(opacity=0.6, color=ATD_COLOR)
         .encode(
-            x=alt.X(f"{atd_col}:Q", bin=alt.Bin(maxbins=50), title="ATD"),
-            y=alt.Y("count():Q", title="Trips (n)"),
-            tooltip=[alt.Tooltip("count():Q", title="Trips (n)", format=",")],
+            x=alt.X("atd_lo:Q", title="ATD"),
+            x2="atd_hi:Q",
+            y=alt.Y("count:Q", title="Trips (n)"),
+            tooltip=[
+                alt.Tooltip("atd_lo:Q", title="ATD from", format=".2f"),
+                alt.Tooltip("atd_hi:Q", title="ATD to", format=".2f"),
+                alt.Tooltip("count:Q", title="Trips (n)", format=","),
+            ],
         )
         .properties(height=300)
     )
@@ -0,0 +1,24 @@
+"""
+One-off conversion of the dashboard CSV exports to Parquet.
+
+Usage: python to_parquet.py data_complete.csv data_without_outliers.csv
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+
+import pandas as pd
+
+
+def convert(csv_path: str) -> str:
+    parquet_path = os.path.splitext(csv_path)[0] + ".parquet"
+    df = pd.read_csv(csv_path)
+    df.to_parquet(parquet_path, compression="zstd", index=False)
+    return parquet_path
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(f"{path} -> {convert(path)}")
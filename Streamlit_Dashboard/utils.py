@@ -6,8 +6,14 @@ from __future__ import annotations
 import pandas as pd
 import numpy as np
 import altair as alt
+from numba import config as numba_config, njit, prange
 from typing import Iterable, Optional, Tuple
 
+# Streamlit runs each session's script in its own thread; the parallel filter
+# kernel needs a thread-safe layer. OpenMP first: TBB launched off the main
+# thread hangs the interpreter at exit. workqueue is kept only as a last resort.
+numba_config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
 # ===== Config colores =====
 ATD_COLOR = "#03c167"
 TRIPS_COLOR = "#ffc043"
@@ -29,6 +35,19 @@ CANONICAL_COLS = {
     "atd": ["ATD", "atd", "avg_time_to_deliver"],
 }
 
+# Bump whenever add_derived_fields changes its output: the app's on-disk
+# prepared-frame cache is rebuilt when this no longer matches.
+PREPARED_VERSION = 1
+
+# Every candidate name, in order; the loader only materializes these columns.
+NEEDED = list(dict.fromkeys(c for candidates in CANONICAL_COLS.values() for c in candidates))
+
+DAY_LABELS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+WEEKEND_LABELS = ["Weekday", "Weekend"]
+
+# Low-cardinality dimensions stored as pandas Categoricals
+CATEGORICAL_KEYS = ("territory", "geo_archetype", "courier_flow", "merchant_surface")
+
 def find_first_present(df: pd.DataFrame, candidates: Iterable[str]) -> Optional[str]:
     for c in candidates:
         if c in df.columns:
@@ -42,19 +61,99 @@ def resolve_columns(df: pd.DataFrame) -> dict:
     return mapping
 
 def _parse_datetime(series: pd.Series) -> pd.Series:
-    return pd.to_datetime(series, errors="coerce", infer_datetime_format=True)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    # Exports are ISO "YYYY-MM-DD HH:MM:SS[.fff]": the ISO8601 parser stays on the
+    # C fast path for both, and cache=True reuses repeated timestamps.
+    return pd.to_datetime(series, format="ISO8601", errors="coerce", cache=True)
 
 def add_derived_fields(df: pd.DataFrame, cols: dict) -> pd.DataFrame:
-    out = df.copy()
+    """Add the dashboard's derived columns to ``df`` in place and return it.
+
+    The caller hands ``df`` over: it is not copied, so its columns are coerced
+    and extended directly. Pass ``df.copy()`` to keep the original intact.
+    """
+    out = df
     eat_col = cols.get("eater_request_ts")
     if eat_col and eat_col in out.columns:
         out["_eater_request_dt"] = _parse_datetime(out[eat_col])
     else:
         out["_eater_request_dt"] = pd.NaT
+    # Temporal fields (NaT rows get <NA> hour/day and no day label)
+    dt = out["_eater_request_dt"].dt
+    dow = dt.dayofweek
+    out["hour_of_day"] = dt.hour.astype("Int8")
+    out["day_of_week"] = dow.astype("Int8")  # 0=Mon..6=Sun
+    out["is_weekend"] = dow >= 5
+    out["_dow_label"] = pd.Categorical.from_codes(
+        dow.fillna(-1).astype("int8"), categories=DAY_LABELS
+    )
+    out["_is_weekend_label"] = pd.Categorical.from_codes(
+        out["is_weekend"].astype("int8"), categories=WEEKEND_LABELS
+    )
+    out["date"] = dt.normalize()
     for nm in ("pickup_distance", "dropoff_distance", "atd"):
         col = cols.get(nm)
         if col and col in out.columns:
-            out[col] = pd.to_numeric(out[col], errors="coerce")
+            # float32 is plenty for km / minutes and halves the bytes every scan reads
+            out[col] = pd.to_numeric(out[col], errors="coerce").astype("float32")
+    for nm in CATEGORICAL_KEYS:
+        col = cols.get(nm)
+        if col and col in out.columns:
+            out[col] = out[col].astype("category")
+    return out
+
+@njit(parallel=True, cache=True)
+def _filter_kernel(codes, bitmasks, pickup, plo, phi, dropoff, dlo, dhi, dt_ns, tlo, thi, out):
+    # One fused pass: row i is kept when every category code is set in its dim's
+    # bitmask and every range holds. An empty range array means "not filtered".
+    use_p = pickup.shape[0] > 0
+    use_d = dropoff.shape[0] > 0
+    use_t = dt_ns.shape[0] > 0
+    for i in prange(out.shape[0]):
+        keep = True
+        for j in range(codes.shape[0]):
+            c = codes[j, i]
+            if c < 0 or ((bitmasks[j] >> np.uint64(c)) & np.uint64(1)) == 0:
+                keep = False
+                break
+        if keep and use_p:
+            keep = pickup[i] >= plo and pickup[i] <= phi
+        if keep and use_d:
+            keep = dropoff[i] >= dlo and dropoff[i] <= dhi
+        if keep and use_t:
+            keep = dt_ns[i] >= tlo and dt_ns[i] <= thi
+        out[i] = keep
+
+def _fused_mask(n, cat_filters, pickup, dropoff, dates):
+    codes = np.empty((len(cat_filters), n), dtype=np.int16)
+    bitmasks = np.zeros(len(cat_filters), dtype=np.uint64)
+    for j, (s, values) in enumerate(cat_filters):
+        codes[j] = s.cat.codes.to_numpy()
+        for code in s.cat.categories.get_indexer(list(values)):
+            if code >= 0:
+                bitmasks[j] |= np.uint64(1) << np.uint64(code)
+    no_floats = np.empty(0, dtype=np.float32)
+    parr, plo, phi = pickup or (no_floats, 0.0, 0.0)
+    darr, dlo, dhi = dropoff or (no_floats, 0.0, 0.0)
+    tarr, tlo, thi = dates or (np.empty(0, dtype=np.int64), 0, 0)
+    out = np.empty(n, dtype=np.bool_)
+    _filter_kernel(codes, bitmasks, parr, plo, phi, darr, dlo, dhi, tarr, tlo, thi, out)
+    return out
+
+def column_bounds(df: pd.DataFrame, columns: Iterable[str]) -> dict:
+    """Map each column to ``(min, max, has_na)`` for no-op filter detection.
+
+    Categorical columns only carry the null flag (min/max are ``None``).
+    """
+    out = {}
+    for c in columns:
+        s = df[c]
+        has_na = bool(s.isna().any())
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            out[c] = (None, None, has_na)
+        else:
+            out[c] = (s.min(), s.max(), has_na)
     return out
 
 def filter_frame(
@@ -67,41 +166,165 @@ def filter_frame(
     date_range=None,
     pickup_range=None,
     dropoff_range=None,
+    bounds: Optional[dict] = None,
 ):
-    mask = pd.Series(True, index=df.index)
-    def apply_cat(col_key, values):
-        nonlocal mask
+    """Rows matching the sidebar filters; ``df`` itself when none of them narrows it.
+
+    An empty categorical selection applies no filter (rows with a missing value
+    are kept); any non-empty selection keeps only rows whose value is selected.
+    ``bounds`` (see ``column_bounds``) lets selections covering every category of
+    a null-free column, and ranges spanning a column's full extent, be skipped;
+    without it every given filter is applied.
+    """
+    bounds = bounds or {}
+    def narrows(col, lo, hi):
+        if col not in bounds:
+            return True
+        cmin, cmax, has_na = bounds[col]
+        # between() also drops missing values, so a column with NaNs always narrows
+        return has_na or lo > cmin or hi < cmax
+    cat_filters = []
+    for col_key, values in (
+        ("territory", territory),
+        ("geo_archetype", geo_archetype),
+        ("courier_flow", courier_flow),
+        ("merchant_surface", merchant_surface),
+    ):
         col = cols.get(col_key)
-        if col and values:
-            mask &= df[col].isin(values)
-    apply_cat("territory", territory)
-    apply_cat("geo_archetype", geo_archetype)
-    apply_cat("courier_flow", courier_flow)
-    apply_cat("merchant_surface", merchant_surface)
-    if date_range and cols.get("eater_request_ts"):
-        start, end = date_range
-        dt = df["_eater_request_dt"]
-        mask &= (dt >= start) & (dt <= end)
-    if pickup_range and cols.get("pickup_distance"):
-        mask &= df[cols["pickup_distance"]].between(*pickup_range)
-    if dropoff_range and cols.get("dropoff_distance"):
-        mask &= df[cols["dropoff_distance"]].between(*dropoff_range)
-    return df[mask]
+        # An empty selection means "all values": nothing to mask.
+        if not col or not values:
+            continue
+        s = df[col]
+        if (
+            isinstance(s.dtype, pd.CategoricalDtype)
+            and len(set(values)) >= len(s.cat.categories)
+            and col in bounds
+            and not bounds[col][2]
+        ):
+            continue
+        cat_filters.append((s, values))
+    def float_range(col, rng):
+        arr = df[col].to_numpy()
+        # Compare in the column's own dtype: float32(2.3) < 2.3, so float64 bounds
+        # would drop rows sitting exactly on a slider step.
+        lo, hi = (arr.dtype.type(v) for v in rng)
+        return (arr, lo, hi) if narrows(col, lo, hi) else None
+    pickup = dropoff = dates = None
+    pcol, dcol = cols.get("pickup_distance"), cols.get("dropoff_distance")
+    if pickup_range and pcol:
+        pickup = float_range(pcol, pickup_range)
+    if dropoff_range and dcol:
+        dropoff = float_range(dcol, dropoff_range)
+    if (
+        date_range
+        and "_eater_request_dt" in df.columns
+        and narrows("_eater_request_dt", *map(pd.Timestamp, date_range))
+    ):
+        dt_arr = df["_eater_request_dt"].to_numpy()
+        # int64 ticks in the column's unit; NaT is int64 min and falls outside any range
+        dates = (
+            dt_arr.view("int64"),
+            *(int(pd.Timestamp(t).to_datetime64().astype(dt_arr.dtype).astype("int64")) for t in date_range),
+        )
+
+    if not cat_filters and pickup is None and dropoff is None and dates is None:
+        return df
+    if all(
+        isinstance(s.dtype, pd.CategoricalDtype) and len(s.cat.categories) <= 64
+        for s, _ in cat_filters
+    ):
+        return df.iloc[_fused_mask(len(df), cat_filters, pickup, dropoff, dates)]
+
+    # Fallback (dims that don't fit a 64-bit mask): one NumPy pass per filter
+    mask = np.ones(len(df), dtype=bool)
+    for s, values in cat_filters:
+        np.logical_and(mask, s.isin(values).to_numpy(), out=mask)
+    for rng in (pickup, dropoff, dates):
+        if rng is not None:
+            arr, lo, hi = rng
+            np.logical_and(mask, (arr >= lo) & (arr <= hi), out=mask)
+    return df.iloc[mask]
 
 def kpi_series(df: pd.DataFrame, atd_col: Optional[str]) -> dict:
-    if not atd_col or atd_col not in df.columns or df[atd_col].dropna().empty:
-        return {"count": 0, "mean": np.nan, "median": np.nan, "p90": np.nan}
-    s = df[atd_col].dropna().astype(float)
-    return {"count": int(s.count()), "mean": s.mean(), "median": s.median(), "p90": s.quantile(0.9)}
+    empty = {"count": 0, "mean": np.nan, "median": np.nan, "p90": np.nan}
+    if not atd_col or atd_col not in df.columns:
+        return empty
+    arr = df[atd_col].to_numpy()
+    arr = arr[~np.isnan(arr)]
+    n = arr.size
+    if n == 0:
+        return empty
+    # Linear-interpolated quantiles (pandas' default) from one O(n) partition
+    # instead of a full sort: only the two neighbours of each position matter.
+    pos = np.array([0.5, 0.9]) * (n - 1)
+    lo, hi = np.floor(pos).astype(int), np.ceil(pos).astype(int)
+    part = np.partition(arr, np.unique(np.concatenate([lo, hi])))
+    q = part[lo] + (part[hi] - part[lo]) * (pos - lo)
+    return {"count": int(n), "mean": float(arr.mean(dtype="float64")), "median": float(q[0]), "p90": float(q[1])}
 
 # ===== Gráficas =====
+def agg_by_codes(df_in, dim, atd_col):
+    # Same output as the groupby path, straight from the category codes:
+    # count = rows per category, mean over non-null ATD, unobserved categories dropped.
+    cat = df_in[dim].cat
+    codes = cat.codes.to_numpy()
+    vals = df_in[atd_col].to_numpy(dtype="float64", na_value=np.nan)
+    n = cat.categories.size
+    present = codes >= 0
+    valid = present & ~np.isnan(vals)
+    counts = np.bincount(codes[present], minlength=n)
+    sums = np.bincount(codes[valid], weights=vals[valid], minlength=n)
+    n_valid = np.bincount(codes[valid], minlength=n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / n_valid
+    keep = counts > 0
+    return pd.DataFrame(
+        {"dim": cat.categories[keep], "ATD_mean": means[keep], "count": counts[keep]}
+    )
+
 def agg_by(df_in, dim, atd_col):
+    if isinstance(df_in[dim].dtype, pd.CategoricalDtype):
+        return agg_by_codes(df_in, dim, atd_col)
+    # observed=True: no rows for categories absent from the filtered frame.
+    # sort=False skips sorting the groups; the few result rows are sorted instead.
     return (
-        df_in.groupby(dim)[atd_col]
+        df_in.groupby(dim, observed=True, sort=False)[atd_col]
         .agg(ATD_mean="mean", count="size")
         .reset_index()
         .rename(columns={dim: "dim"})
+        .sort_values("dim", ignore_index=True)
+    )
+
+def histogram_frame(series, bins=50):
+    vals = series.to_numpy(dtype="float64", na_value=np.nan)
+    vals = vals[~np.isnan(vals)]
+    counts, edges = np.histogram(vals, bins=bins)
+    return pd.DataFrame({"atd_lo": edges[:-1], "atd_hi": edges[1:], "count": counts})
+
+def grid_frame(df_in, x_col, y_col, atd_col, bins=25):
+    # Rectangular bins over x/y: trips and mean ATD per cell (empty cells omitted)
+    x = df_in[x_col].to_numpy(dtype="float64")
+    y = df_in[y_col].to_numpy(dtype="float64")
+    if x.size == 0:
+        return pd.DataFrame(columns=["x_lo", "x_hi", "y_lo", "y_hi", "count", "atd_mean"])
+    x0, y0 = x.min(), y.min()
+    wx = (x.max() - x0) / bins or 1.0
+    wy = (y.max() - y0) / bins or 1.0
+    cells = pd.DataFrame({
+        "xbin": np.minimum(np.floor((x - x0) / wx), bins - 1).astype("int16"),
+        "ybin": np.minimum(np.floor((y - y0) / wy), bins - 1).astype("int16"),
+        "atd": df_in[atd_col].to_numpy(),
+    })
+    out = (
+        cells.groupby(["xbin", "ybin"], observed=True, sort=False)["atd"]
+        .agg(count="size", atd_mean="mean")
+        .reset_index()
     )
+    out["x_lo"] = x0 + out["xbin"] * wx
+    out["x_hi"] = out["x_lo"] + wx
+    out["y_lo"] = y0 + out["ybin"] * wy
+    out["y_hi"] = out["y_lo"] + wy
+    return out[["x_lo", "x_hi", "y_lo", "y_hi", "count", "atd_mean"]]
 
 def bar_chart(df_in, x_title, y_field, color, domain_order=None, label=False):
     data = df_in.copy()